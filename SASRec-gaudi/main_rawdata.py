@@ -29,8 +29,18 @@ parser.add_argument('--device', default='hpu', type=str, help='cpu, hpu')
 parser.add_argument('--inference_only', default=False, action='store_true')
 parser.add_argument('--nn_parameter', default=False, action='store_true')
 parser.add_argument('--state_dict_path', default=None, type=str)
+parser.add_argument('--compile', default=False, action='store_true', help='torch.compile the training forward')
+parser.add_argument('--bf16', default=False, action='store_true', help='bf16 autocast for the sequence encoder')
+parser.add_argument('--max_grad_norm', default=None, type=float, help='gradient clipping, 0 = no clipping (default: 1.0 with --bf16, otherwise 0)')
+parser.add_argument('--int8_predict', default=False, action='store_true', help='score items with an int8 item table in eval mode')
+parser.add_argument('--sparse_attention', default='none', choices=['none', 'topk', 'mean'], help='prune attention scores per query')
+parser.add_argument('--sparse_k', default=10, type=int, help='keys kept per query for --sparse_attention topk; sequences of at most sparse_k items use dense attention')
+parser.add_argument('--loss', default='bce', choices=['bce', 'sampled_ce'], help='bce on one negative, or sampled softmax')
+parser.add_argument('--neg_k', default=100, type=int, help='negatives per position for --loss sampled_ce')
 
 args = parser.parse_args()
+if args.max_grad_norm is None:
+    args.max_grad_norm = 1.0 if args.bf16 else 0.0
 
 if __name__ == '__main__':
 
@@ -69,22 +79,35 @@ if __name__ == '__main__':
         try:
             kwargs, checkpoint = torch.load(args.state_dict_path, map_location=torch.device(args.device))
             kwargs['args'].device = args.device
+            # runtime options come from the command line, not from the args pickled with the checkpoint
+            for name in ('bf16', 'int8_predict', 'sparse_attention', 'sparse_k'):
+                setattr(kwargs['args'], name, getattr(args, name))
             model = SASRec(**kwargs).to(args.device)
             model.load_state_dict(checkpoint)
             tail = args.state_dict_path[args.state_dict_path.find('epoch=') + 6:]
             epoch_start_idx = int(tail[:tail.find('.')]) + 1
-        except:
+        except Exception as e:
+            print(e)
             print('failed loading state_dicts, pls check file path: ', end="")
             print(args.state_dict_path)
             print('pdb enabled for your quick check, pls type exit() if you do not need it')
             import pdb; pdb.set_trace()
 
+    # compiled wrapper shares parameters with model; model itself is kept for predict/evaluate and saving
+    train_model = model
+    if args.compile:
+        if torch.device(args.device).type == 'hpu':
+            train_model = torch.compile(model, backend='hpu_backend', dynamic=False)
+        else:
+            train_model = torch.compile(model, mode='reduce-overhead', fullgraph=False, dynamic=False)
+
     if args.inference_only:
         model.eval()
         t_test = evaluate(model, dataset, args)
         print('test (NDCG@10: %.4f, HR@10: %.4f)' % (t_test[0], t_test[1]))
 
     bce_criterion = torch.nn.BCEWithLogitsLoss()
+    ce_criterion = torch.nn.CrossEntropyLoss()
     adam_optimizer = torch.optim.Adam(model.parameters(), lr=args.lr, betas=(0.9, 0.98))
 
     time_list = []
@@ -101,14 +124,20 @@ if __name__ == '__main__':
         for step in range(num_batch):
             u, seq, pos, neg = sampler.next_batch()
             u, seq, pos, neg = np.array(u), np.array(seq), np.array(pos), np.array(neg)
-
-            pos_logits, neg_logits = model(u, seq, pos, neg)
-            pos_labels, neg_labels = torch.ones(pos_logits.shape, device=args.device), torch.zeros(neg_logits.shape, device=args.device)
+            seq, pos, neg = to_device_tensor(seq, args.device), to_device_tensor(pos, args.device), to_device_tensor(neg, args.device)
 
             adam_optimizer.zero_grad()
-            indices = np.where(pos != 0)
-            loss = bce_criterion(pos_logits[indices], pos_labels[indices])
-            loss += bce_criterion(neg_logits[indices], neg_labels[indices])
+            indices = torch.where(pos != 0)
+            if args.loss == 'sampled_ce':
+                # column 0 of the logits is the positive item
+                logits = train_model(u, seq, pos, None, mode='sampled_ce', neg_k=args.neg_k)
+                loss = ce_criterion(logits[indices], torch.zeros(indices[0].shape, dtype=torch.long, device=args.device))
+            else:
+                pos_logits, neg_logits = train_model(u, seq, pos, neg)
+                pos_labels, neg_labels = torch.ones(pos_logits.shape, device=args.device), torch.zeros(neg_logits.shape, device=args.device)
+
+                loss = bce_criterion(pos_logits[indices], pos_labels[indices])
+                loss += bce_criterion(neg_logits[indices], neg_labels[indices])
 
             #nn.Embedding
             if args.nn_parameter:
@@ -118,6 +147,8 @@ if __name__ == '__main__':
 
             #GAUDI
             loss.backward()
+            if args.max_grad_norm > 0:
+                torch.nn.utils.clip_grad_norm_(model.parameters(), args.max_grad_norm)
             if args.device =='hpu':
                 htcore.mark_step()
             adam_optimizer.step()
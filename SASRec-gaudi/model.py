@@ -1,23 +1,87 @@
-import numpy as np
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 class PointWiseFeedForward(torch.nn.Module):
     def __init__(self, hidden_units, dropout_rate):
 
         super(PointWiseFeedForward, self).__init__()
 
-        self.conv1 = torch.nn.Conv1d(hidden_units, hidden_units, kernel_size=1)
+        self.fc1 = torch.nn.Linear(hidden_units, hidden_units)
         self.dropout1 = torch.nn.Dropout(p=dropout_rate)
         self.relu = torch.nn.ReLU()
-        self.conv2 = torch.nn.Conv1d(hidden_units, hidden_units, kernel_size=1)
+        self.fc2 = torch.nn.Linear(hidden_units, hidden_units)
         self.dropout2 = torch.nn.Dropout(p=dropout_rate)
 
     def forward(self, inputs):
-        outputs = self.dropout2(self.conv2(self.relu(self.dropout1(self.conv1(inputs.transpose(-1, -2))))))
-        outputs = outputs.transpose(-1, -2)
-        outputs += inputs
-        return outputs
+        return self.dropout2(self.fc2(self.relu(self.dropout1(self.fc1(inputs)))))
+
+# multi-head causal self-attention on (B, T, C) with a packed QKV projection; the causal mask is handled
+# by SDPA (is_causal) so the fused flash / memory-efficient kernels can be used instead of materializing QK^T
+class CausalSelfAttention(torch.nn.Module):
+    def __init__(self, hidden_units, num_heads, dropout_rate, maxlen, sparse_attention='none', sparse_k=10):
+
+        super(CausalSelfAttention, self).__init__()
+
+        assert hidden_units % num_heads == 0, 'hidden_units must be divisible by num_heads'
+        self.hidden_units = hidden_units
+        self.num_heads = num_heads
+        self.head_dim = hidden_units // num_heads
+        self.dropout_rate = dropout_rate
+        self.sparse_attention = sparse_attention
+        self.sparse_k = sparse_k
+
+        self.qkv = torch.nn.Linear(hidden_units, 3 * hidden_units)
+        self.out = torch.nn.Linear(hidden_units, hidden_units)
+        # same init as nn.MultiheadAttention
+        torch.nn.init.xavier_uniform_(self.qkv.weight)
+        torch.nn.init.constant_(self.qkv.bias, 0.)
+        torch.nn.init.constant_(self.out.bias, 0.)
+
+        # only the sparse path reads the mask; dense SDPA uses is_causal
+        if sparse_attention != 'none':
+            self.register_buffer('causal_mask', ~torch.tril(torch.ones((maxlen, maxlen), dtype=torch.bool)), persistent=False)
+
+    def forward(self, x):
+        batch_size, tl, _ = x.shape
+        q, k, v = self.qkv(x).chunk(3, dim=-1)
+        q, k, v = (t.view(batch_size, tl, self.num_heads, self.head_dim).transpose(1, 2) for t in (q, k, v))
+
+        dropout_p = self.dropout_rate if self.training else 0.0
+        # top-k prunes nothing until a query has more than sparse_k causal keys, so shorter sequences stay on dense SDPA;
+        # mean-threshold pruning applies at any length
+        if self.sparse_attention == 'mean' or (self.sparse_attention == 'topk' and tl > self.sparse_k):
+            outputs = self.sparse_causal_attention(q, k, v, dropout_p)
+        else:
+            outputs = F.scaled_dot_product_attention(q, k, v, dropout_p=dropout_p, is_causal=True)
+        outputs = outputs.transpose(1, 2).contiguous().view(batch_size, tl, self.hidden_units)
+        return self.out(outputs)
+
+    # causal attention that keeps, per query, only the top-k scores ('topk') or the scores above the row mean ('mean')
+    def sparse_causal_attention(self, q, k, v, dropout_p):
+        tl = q.shape[-2]
+        causal_mask = self.causal_mask[:tl, :tl]
+        scores = q.matmul(k.transpose(-2, -1)) / q.shape[-1] ** 0.5
+
+        if self.sparse_attention == 'topk':
+            threshold = scores.masked_fill(causal_mask, float('-inf')).topk(self.sparse_k, dim=-1).values[..., -1:]
+        else:
+            threshold = scores.masked_fill(causal_mask, 0.0).sum(dim=-1, keepdim=True) / (~causal_mask).sum(dim=-1, keepdim=True)
+
+        scores = scores.masked_fill(causal_mask | (scores < threshold), float('-inf'))
+        weights = F.dropout(scores.softmax(dim=-1), p=dropout_p)
+        return weights.matmul(v)
+
+# tensor-only entry point so predict() can be traced with torch.jit.trace, see SASRec.to_traced
+class SASRecPredictor(torch.nn.Module):
+    def __init__(self, model):
+
+        super(SASRecPredictor, self).__init__()
+
+        self.model = model
+
+    def forward(self, log_seqs, item_indices):
+        return self.model.predict(None, log_seqs, item_indices)
 
 class SASRec(torch.nn.Module):
     def __init__(self, user_num, item_num, args):
@@ -29,6 +93,9 @@ class SASRec(torch.nn.Module):
         self.dev = args.device
         self.embedding_dim = args.hidden_units
         self.nn_parameter = args.nn_parameter
+        self.device_type = torch.device(args.device).type
+        self.bf16 = getattr(args, 'bf16', False)
+        self.int8_predict = getattr(args, 'int8_predict', False)
 
         if self.nn_parameter:
             self.item_emb = nn.Parameter(torch.normal(0,1, size = (self.item_num+1, args.hidden_units)))
@@ -39,6 +106,10 @@ class SASRec(torch.nn.Module):
             self.pos_emb = torch.nn.Embedding(args.maxlen, args.hidden_units)
 
         self.emb_dropout = torch.nn.Dropout(p=args.dropout_rate)
+        self.register_buffer('positions', torch.arange(args.maxlen).unsqueeze(0), persistent=False)
+        # int8 copy of the item table (per-row scale) used by predict() in eval mode, see quantize_item_emb
+        self.register_buffer('item_emb_int8', None, persistent=False)
+        self.register_buffer('item_emb_scale', None, persistent=False)
 
         self.attention_layernorms = torch.nn.ModuleList()
         self.attention_layers = torch.nn.ModuleList()
@@ -54,9 +125,12 @@ class SASRec(torch.nn.Module):
             new_attn_layernorm = torch.nn.LayerNorm(args.hidden_units, eps=1e-8)
             self.attention_layernorms.append(new_attn_layernorm)
 
-            new_attn_layer =  torch.nn.MultiheadAttention(args.hidden_units,
-                                                            args.num_heads,
-                                                            args.dropout_rate)
+            new_attn_layer = CausalSelfAttention(args.hidden_units,
+                                                 args.num_heads,
+                                                 args.dropout_rate,
+                                                 args.maxlen,
+                                                 getattr(args, 'sparse_attention', 'none'),
+                                                 getattr(args, 'sparse_k', 10))
             self.attention_layers.append(new_attn_layer)
 
             new_fwd_layernorm = torch.nn.LayerNorm(args.hidden_units, eps=1e-8)
@@ -65,81 +139,140 @@ class SASRec(torch.nn.Module):
             new_fwd_layer = PointWiseFeedForward(args.hidden_units, args.dropout_rate)
             self.forward_layers.append(new_fwd_layer)
 
-    def log2feats(self, log_seqs):
+    # checkpoints from the post-norm block (Conv1d FFN / nn.MultiheadAttention keys) compute different features
+    # with these blocks, so refuse them instead of loading weights that no longer mean the same thing
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        legacy = [k for k in state_dict if k.startswith(prefix) and k.endswith(('.conv1.weight', '.in_proj_weight'))]
+        if legacy:
+            raise RuntimeError('checkpoint uses the old SASRec block layout (%s); it is not compatible with the '
+                               'pre-norm blocks and has to be retrained' % legacy[0])
+        super(SASRec, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    @torch.no_grad()
+    def quantize_item_emb(self):
+        weight = self.item_emb if self.nn_parameter else self.item_emb.weight
+        scale = weight.abs().amax(dim=-1).clamp(min=1e-8) / 127
+        self.item_emb_int8 = torch.round(weight / scale.unsqueeze(-1)).to(torch.int8)
+        self.item_emb_scale = scale.half()
+
+    def train(self, mode=True):
+        super(SASRec, self).train(mode)
+        if self.int8_predict:
+            if mode:
+                self.item_emb_int8, self.item_emb_scale = None, None
+            else:
+                self.quantize_item_emb()
+        return self
+
+    # batches from the training loop are already device LongTensors, numpy inputs (evaluate) are converted here
+    def to_device(self, ids):
+        if torch.is_tensor(ids):
+            return ids.to(self.dev, non_blocking=True)
+        return torch.LongTensor(ids).to(self.dev)
+
+    # nn.Parameter tables keep plain indexing: it is the HPU workaround for the nn.Embedding kernel (see README)
+    def item_lookup(self, ids):
         if self.nn_parameter:
-            seqs = self.item_emb[torch.LongTensor(log_seqs).to(self.dev)]
-            seqs *= self.embedding_dim **0.5
-        else:
-            seqs = self.item_emb(torch.LongTensor(log_seqs).to(self.dev))
-            seqs *= self.item_emb.embedding_dim ** 0.5
+            return self.item_emb[ids]
+        return F.embedding(ids, self.item_emb.weight, padding_idx=0)
 
-        positions = np.tile(np.array(range(log_seqs.shape[1])), [log_seqs.shape[0], 1])
-
-        #nn.Embedding
+    def pos_lookup(self, positions):
         if self.nn_parameter:
-            seqs += self.pos_emb[torch.LongTensor(positions).to(self.dev)]
-        else:
-            seqs += self.pos_emb(torch.LongTensor(positions).to(self.dev))
-
-        seqs = self.emb_dropout(seqs)
+            return self.pos_emb[positions]
+        return F.embedding(positions, self.pos_emb.weight)
 
-        timeline_mask = torch.BoolTensor(log_seqs == 0).to(self.dev)
-        seqs *= ~timeline_mask.unsqueeze(-1)
+    def log2feats(self, log_seqs):
+        log_seqs = self.to_device(log_seqs)
+        positions = self.positions[:, :log_seqs.size(1)].expand(log_seqs.size(0), -1)
+        # pos_emb + sqrt(d) * item_emb in one kernel
+        seqs = torch.add(self.pos_lookup(positions), self.item_lookup(log_seqs), alpha=self.embedding_dim ** 0.5)
 
-        tl = seqs.shape[1]
-        attention_mask = ~torch.tril(torch.ones((tl, tl), dtype=torch.bool, device=self.dev))
+        seqs = self.emb_dropout(seqs)
 
-        for i in range(len(self.attention_layers)):
-            seqs = torch.transpose(seqs, 0, 1)
-            Q = self.attention_layernorms[i](seqs)
-            mha_outputs, _ = self.attention_layers[i](Q, seqs, seqs,
-                                            attn_mask=attention_mask)
+        timeline_mask = log_seqs.eq(0).unsqueeze(-1)
+        seqs.masked_fill_(timeline_mask, 0.0)
 
-            seqs = Q + mha_outputs
-            seqs = torch.transpose(seqs, 0, 1)
+        blocks = zip(self.attention_layernorms, self.attention_layers, self.forward_layernorms, self.forward_layers)
+        for attn_layernorm, attn_layer, fwd_layernorm, fwd_layer in blocks:
+            # pre-norm: x = x + attn(LN(x)); x = x + ffn(LN(x))
+            Q = attn_layernorm(seqs)
+            seqs = seqs + attn_layer(Q)
 
-            seqs = self.forward_layernorms[i](seqs)
-            seqs = self.forward_layers[i](seqs)
-            seqs *=  ~timeline_mask.unsqueeze(-1)
+            # in-place residual on the fresh FFN output (dropout's backward does not need its output); under bf16
+            # autocast the FFN output is cast back first so the residual stream stays in seqs' dtype
+            seqs = fwd_layer(fwd_layernorm(seqs)).to(seqs.dtype).add_(seqs)
+            seqs.masked_fill_(timeline_mask, 0.0)
 
         log_feats = self.last_layernorm(seqs)
         return log_feats
 
-    def forward(self, user_ids, log_seqs, pos_seqs, neg_seqs, mode='default'):
-        log_feats = self.log2feats(log_seqs)
+    def forward(self, user_ids, log_seqs, pos_seqs, neg_seqs, mode='default', neg_k=100):
+        with torch.autocast(device_type=self.device_type, dtype=torch.bfloat16, enabled=self.bf16):
+            log_feats = self.log2feats(log_seqs)
         if mode == 'log_only':
             log_feats = log_feats[:, -1, :]
             return log_feats
 
-        #nn.Embedding
-        if self.nn_parameter:
-            pos_embs = self.item_emb[torch.LongTensor(pos_seqs).to(self.dev)]
-            neg_embs = self.item_emb[torch.LongTensor(neg_seqs).to(self.dev)]
-        else:
-            pos_embs = self.item_emb(torch.LongTensor(pos_seqs).to(self.dev))
-            neg_embs = self.item_emb(torch.LongTensor(neg_seqs).to(self.dev))
+        if mode == 'sampled_ce':
+            return self.sampled_logits(log_feats, pos_seqs, neg_seqs, neg_k)
+
+        # one gather and one contraction over log_feats for both positives and negatives
+        item_seqs = torch.stack([self.to_device(pos_seqs), self.to_device(neg_seqs)])
+        item_embs = self.item_lookup(item_seqs)
+        pos_embs, neg_embs = item_embs.unbind(0)
 
-        pos_logits = (log_feats * pos_embs).sum(dim=-1)
-        neg_logits = (log_feats * neg_embs).sum(dim=-1)
+        pos_logits, neg_logits = torch.einsum('bth,kbth->kbt', log_feats, item_embs).unbind(0)
 
         # pos_pred = self.pos_sigmoid(pos_logits)
         # neg_pred = self.neg_sigmoid(neg_logits)
         if mode == 'item':
             return log_feats.reshape(-1, log_feats.shape[2]), pos_embs.reshape(-1, log_feats.shape[2]), neg_embs.reshape(-1, log_feats.shape[2])
         else:
-            return pos_logits, neg_logits
+            # BCE on logits in fp32
+            return pos_logits.float(), neg_logits.float()
+
+    # logits over [pos, neg_1..neg_k] per position (target class 0); neg_seqs (B, T, K) or None to draw
+    # neg_k uniform negatives on device. Only pos + K rows are gathered, never the full item table
+    def sampled_logits(self, log_feats, pos_seqs, neg_seqs, neg_k):
+        pos_seqs = self.to_device(pos_seqs)
+        if neg_seqs is None:
+            neg_seqs = torch.randint(1, self.item_num + 1, (*pos_seqs.shape, neg_k), device=pos_seqs.device)
+        else:
+            neg_seqs = self.to_device(neg_seqs)
+        item_embs = self.item_lookup(torch.cat([pos_seqs.unsqueeze(-1), neg_seqs], dim=-1))
+
+        with torch.autocast(device_type=self.device_type, dtype=torch.bfloat16, enabled=self.bf16):
+            logits = torch.einsum('bth,btkh->btk', log_feats, item_embs)
+        # cross entropy in fp32; negatives that hit the positive item would be both target and negative, mask them out
+        logits = logits.float()
+        logits[..., 1:].masked_fill_(neg_seqs == pos_seqs.unsqueeze(-1), float('-inf'))
+        return logits
 
     def predict(self, user_ids, log_seqs, item_indices):
-        log_feats = self.log2feats(log_seqs)
+        with torch.autocast(device_type=self.device_type, dtype=torch.bfloat16, enabled=self.bf16):
+            log_feats = self.log2feats(log_seqs)
 
         final_feat = log_feats[:, -1, :]
 
-        #nn.Embedding
-        if self.nn_parameter:
-            item_embs = self.item_emb[torch.LongTensor(item_indices).to(self.dev)]
-        else:
-            item_embs = self.item_emb(torch.LongTensor(item_indices).to(self.dev))
+        item_indices = self.to_device(item_indices)
+
+        if self.item_emb_int8 is not None:
+            item_embs = self.item_emb_int8[item_indices].to(final_feat.dtype)
+            logits = item_embs.matmul(final_feat.unsqueeze(-1)).squeeze(-1) * self.item_emb_scale[item_indices]
+            return logits
 
+        item_embs = self.item_lookup(item_indices)
         logits = item_embs.matmul(final_feat.unsqueeze(-1)).squeeze(-1)
 
         return logits
+
+    def to_traced(self, example_log_seqs, example_items, path=None):
+        was_training = self.training
+        self.eval()
+        example_log_seqs, example_items = self.to_device(example_log_seqs), self.to_device(example_items)
+        with torch.inference_mode():
+            traced = torch.jit.trace(SASRecPredictor(self), (example_log_seqs, example_items))
+        self.train(was_training)
+        if path is not None:
+            traced.save(path)
+        return traced
@@ -76,6 +76,10 @@ class WarpSampler(object):
             p.terminate()
             p.join()
 
+# convert a sampled numpy batch to a device LongTensor once per step, so the model does no per-call conversion
+def to_device_tensor(arr, device):
+    return torch.from_numpy(np.asarray(arr)).long().to(device)
+
 # DataSet for ddp
 class SeqDataset(Dataset):
     def __init__(self, user_train, num_user, num_item, max_len):